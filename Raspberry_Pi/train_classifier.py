@@ -6,7 +6,7 @@ import pandas as pd
 from collections import Counter
 
 # import libraries for ML
-from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, recall_score, f1_score
+from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.preprocessing import StandardScaler
 from sklearn.datasets import make_moons, make_circles, make_classification
@@ -75,6 +75,13 @@ ENC_LIST = [
 
 CLASSLIST = [ pair[0] for pair in ENC_LIST ]
 
+ENC_NAME_TO_ID = dict(ENC_LIST)
+
+LABELS = np.array([ pair[0] for pair in sorted(ENC_LIST, key=lambda pair: pair[1]) ])
+
+# Every possible comma separated list of labels, indexed by the bitmask of the classes it contains
+MULTIBUCKET_LABELS = np.array([ ", ".join(LABELS[[ bool(code >> i & 1) for i in range(len(LABELS)) ]]) for code in range(2 ** len(LABELS)) ])
+
 ENC_DICT = {
     0: 'WALKING',
     1: 'WALKING_UPSTAIRS',
@@ -92,30 +99,32 @@ ENC_DICT = {
 
 # Obtain best class from a given list of class probabilities for every prediction
 def onehot2str(onehot):
-       enc_dict = dict([(i[1],i[0]) for i in ENC_LIST])
-       idx_list = np.argmax(onehot, axis=1).tolist()
-       result_str = []
-       for i in idx_list:
-               result_str.append(enc_dict[i])
-       return np.asarray(result_str)
+    return LABELS[np.argmax(onehot, axis=1)]
 
 # Convert a class to its corresponding one hot vector
 def str2onehot(Y):
-   enc_dict = dict(ENC_LIST)
-   new_Y = []
-   for y in Y:
-       vec = np.zeros((1,len(ENC_LIST)),dtype='float64')
-       vec[ 0, enc_dict[y] ] = 1.
-       new_Y.append(vec)
-   del Y
-   new_Y = np.vstack(new_Y)
-   return new_Y
+    codes = np.fromiter((ENC_NAME_TO_ID[y] for y in Y), dtype=np.int64, count=len(Y))
+    return np.eye(len(ENC_LIST), dtype=np.float32)[codes]
+
+# Element-wise division which yields 0 wherever the denominator is 0, as sklearn does
+def safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype='float64')
+    denominator = np.asarray(denominator, dtype='float64')
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+# Derive per class precision, recall, F1 and support from a confusion matrix (rows are true classes)
+def per_class_scores(cf_matrix):
+    true_positives = np.diag(cf_matrix)
+    predicted = cf_matrix.sum(axis=0)
+    support = cf_matrix.sum(axis=1)
+    precision = safe_divide(true_positives, predicted)
+    recall = safe_divide(true_positives, support)
+    f1 = safe_divide(2 * true_positives, predicted + support)
+    return precision, recall, f1, support
 
 # Computes precision, recall and F1 scores for every class
-def precision_recall_f1(Y_pred, Y_test, classlist):
-    precision = precision_score(Y_test, Y_pred, average=None, labels=classlist)
-    recall = recall_score(Y_test, Y_pred, average=None, labels=classlist)
-    f1 = f1_score(Y_test, Y_pred, average=None, labels=classlist)
+def precision_recall_f1(cf_matrix, classlist):
+    precision, recall, f1, _ = per_class_scores(cf_matrix)
     metrics = {}
     for i in range(0, len(classlist)):
         metrics[classlist[i]] = { 'precision': precision[i], 'recall': recall[i], 'f1': f1[i] }
@@ -125,28 +134,29 @@ def precision_recall_f1(Y_pred, Y_test, classlist):
 # micro: Calculate metrics globally by counting the total true positives, false negatives and false positives.
 # macro: Calculate metrics for each label, and find their unweighted mean.
 # weighted: Calculate metrics for each label, and find their average, weighted by label imbalance.
-def micro_macro_weighted(Y_pred, Y_true):
+def micro_macro_weighted(cf_matrix):
+    precision, recall, f1, support = per_class_scores(cf_matrix)
+    # every sample lands in exactly one cell, so micro precision, recall and f1 all equal accuracy
+    micro = float(safe_divide(np.trace(cf_matrix), cf_matrix.sum()))
+    # like sklearn, macro averages only over classes seen in either the true or predicted labels
+    present = (support + cf_matrix.sum(axis=0)) > 0
     results = {}
-    results['micro_precision'] = precision_score(Y_true, Y_pred, average='micro')
-    results['macro_precision'] = precision_score(Y_true, Y_pred, average='macro')
-    results['weighted_precision'] = precision_score(Y_true, Y_pred, average='weighted')
-    results['micro_recall'] = recall_score(Y_true, Y_pred, average='micro')
-    results['macro_recall'] = recall_score(Y_true, Y_pred, average='macro')
-    results['weighted_recall'] = recall_score(Y_true, Y_pred, average='weighted')
-    results['micro_f1'] = f1_score(Y_true, Y_pred, average='micro')
-    results['macro_f1'] = f1_score(Y_true, Y_pred, average='macro')
-    results['weighted_f1'] = f1_score(Y_true, Y_pred, average='weighted')
+    for name, scores in [('precision', precision), ('recall', recall), ('f1', f1)]:
+        results['micro_' + name] = micro
+        results['macro_' + name] = float(np.mean(scores[present])) if present.any() else 0.
+        results['weighted_' + name] = float(safe_divide(np.dot(scores, support), support.sum()))
     return results
 
 # Calculate and display various accuracy, precision, recall and f1 scores
 def calculatePerformanceMetrics(Y_pred, Y_true, dataset_type):
     assert len(Y_pred) == len(Y_true)
 
-    num_incorrect = len(Y_true) - accuracy_score(Y_true, Y_pred, normalize=False)
-    accuracy = accuracy_score(Y_true, Y_pred)
-    metrics = precision_recall_f1(Y_pred, Y_true, CLASSLIST)
-    # micro_macro_weighted_scores = micro_macro_weighted(Y_pred, Y_true)
+    # Every metric below is derived from this single pass over the predictions
     cf_matrix = confusion_matrix(Y_true, Y_pred, labels=CLASSLIST)
+    num_incorrect = len(Y_true) - np.trace(cf_matrix)
+    accuracy = float(safe_divide(np.trace(cf_matrix), len(Y_true)))
+    metrics = precision_recall_f1(cf_matrix, CLASSLIST)
+    # micro_macro_weighted_scores = micro_macro_weighted(cf_matrix)
 
     logger.info("Results for " + dataset_type + " set...")
     logger.info("Number of cases that were incorrect: " + str(num_incorrect))
@@ -172,26 +182,16 @@ def calculatePerformanceMetrics(Y_pred, Y_true, dataset_type):
     logger.info("Confusion Matrix below " + str(CLASSLIST) + " : ")
     logger.info(str(cf_matrix))
 
-# Obtain a list of class probability values for every prediction
+# Obtain a table of class probability values for every prediction, one column per class
 def recordClassProbabilites(pred):
-    class_probabilities = []
-    for i in range(0, len(pred)):
-        prob_per_sentence = {}
-        for j in range(0, len(pred[i])):
-            prob_per_sentence[ENC_DICT[j]] = pred[i][j]
-        class_probabilities.append(prob_per_sentence)
-    return class_probabilities
+    columns = [ ENC_DICT[i] for i in range(pred.shape[1]) ]
+    return pd.DataFrame(pred, columns=columns)
 
 # Record model confidence on every prediction
 def calculatePredictionConfidence(pred):
     CONFIDENCE_THRESHOLD = 0.65
-    confidence_list = []
-    for probs in pred:
-        if max(probs) > CONFIDENCE_THRESHOLD:
-            confidence_list.append("YES")
-        else:
-            confidence_list.append("NO")
-    return confidence_list
+    labels = np.array(["NO", "YES"])
+    return labels[(np.max(pred, axis=1) > CONFIDENCE_THRESHOLD).astype(np.int8)].tolist()
 
 # # Prepare a detailed log of all incorrect cases
 # def logIncorrectCases(..., appendFileNameString):
@@ -204,23 +204,22 @@ def writeDatasetToExcel(X, y, filepath):
             'Label': y,
             'Text': X
         })
-    writer = pd.ExcelWriter(filepath)
-    df.to_excel(writer, "Sheet1", index=False)
-    writer.save()
+    with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name="Sheet1", index=False)
 
 # Obtain a list of all classes for each prediction for which probability is greater than a threshold
 def prob2str_multibucket(probs,sens):
-    enc_dict = dict([(i[1],i[0]) for i in ENC_LIST])
-    cats = []
-    final_sens = []
-    for (prob,sen) in zip(probs,sens):
-        classes = ""
-        for idx,pro in enumerate(prob):
-            if pro >= PROB_THRESHOLD:
-                classes += enc_dict[idx] + ", "
-        cats.append(classes[:-2])
-        final_sens.append(sen)
-    return np.asarray(cats), final_sens
+    # pair probabilities with sentences like zip does, truncating both to the shorter of the two
+    sens = list(sens)
+    probs = np.asarray(probs)[:len(sens)]
+    sens = sens[:len(probs)]
+    if len(probs) == 0:
+        return np.asarray([]), sens
+    assert probs.ndim == 2 and probs.shape[1] == len(LABELS), \
+        "Expected probabilities of shape (n, " + str(len(LABELS)) + "), got " + str(probs.shape)
+    mask = probs >= PROB_THRESHOLD
+    codes = mask.astype(np.int64).dot(1 << np.arange(mask.shape[1]))
+    return MULTIBUCKET_LABELS[codes], sens
 
 # Initialise neural network model using Keras
 def initialiseModel(model_index):
@@ -336,9 +335,9 @@ if __name__ == "__main__":
     # test_confidence_list = calculatePredictionConfidence(test_pred)
 
     # # Record class probabilities for every prediction
-    # train_dict_list = recordClassProbabilites(train_pred)
-    # # val_dict_list = recordClassProbabilites(val_pred)
-    # test_dict_list = recordClassProbabilites(test_pred)
+    # train_class_probabilities = recordClassProbabilites(train_pred)
+    # # val_class_probabilities = recordClassProbabilites(val_pred)
+    # test_class_probabilities = recordClassProbabilites(test_pred)
 
     # # Prepare a detailed log of all incorrect cases on every prediction as text file
     # logIncorrectCases(..., 'training')
@@ -3,16 +3,16 @@ import logging
 import os, pickle, json, h5py, operator
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from collections import Counter
 
 # import libraries for ML
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, recall_score, f1_score
-from sklearn.utils.class_weight import compute_sample_weight
+from sklearn.metrics import confusion_matrix
 from keras.models import load_model, Model
 from keras.layers import *
 from keras.optimizers import *
-from keras.callbacks import ModelCheckpoint
+from keras.callbacks import Callback
 
 # initialise logger
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +23,29 @@ CG3002_FILEPATH = "\\Users\\pankaj\\Documents\\CG3002"
 
 PROB_THRESHOLD = 0.20
 
+CONFIDENCE_THRESHOLD = 0.65
+
+# set flag to train in mixed precision (float16 compute, float32 master weights)
+# only pays off on GPUs with tensor cores, leave off when training on CPU
+USE_MIXED_PRECISION = False
+
+if USE_MIXED_PRECISION:
+    from keras import mixed_precision
+    mixed_precision.set_global_policy('mixed_float16')
+
+# set flag to JIT compile the training step with XLA, fusing each dense block into one kernel
+USE_XLA = True
+
+# large batches amortise per-step overhead, which dominates on a network this small
+BATCH_SIZE = 1024
+
+# scale Adam's default rate of 0.001 by the square root of the batch size increase over the previous 50,
+# a conservative choice since Adam normalises its updates per parameter (about 0.0045)
+LEARNING_RATE = 0.001 * np.sqrt(BATCH_SIZE / 50.)
+
+# scale the previous 100 epochs at batch size 50 by the batch size increase, so training takes the same number of Adam updates
+EPOCHS = int(round(100 * BATCH_SIZE / 50.))
+
 ENC_LIST = [
     ('WALKING', 0),
     ('WALKING_UPSTAIRS', 1),
@@ -40,6 +63,11 @@ ENC_LIST = [
 
 CLASSLIST = [ pair[0] for pair in ENC_LIST ]
 
+LABELS = np.array([ pair[0] for pair in sorted(ENC_LIST, key=lambda pair: pair[1]) ])
+
+# Every possible comma separated list of labels, indexed by the bitmask of the classes it contains
+MULTIBUCKET_LABELS = np.array([ ", ".join(LABELS[[ bool(code >> i & 1) for i in range(len(LABELS)) ]]) for code in range(2 ** len(LABELS)) ])
+
 ENC_DICT = {
     0: 'WALKING',
     1: 'WALKING_UPSTAIRS',
@@ -55,32 +83,25 @@ ENC_DICT = {
     11: 'LIE_TO_STAND'
 }
 
-# Obtain best class from a given list of class probabilities for every prediction
-def onehot2str(onehot):
-       enc_dict = dict([(i[1],i[0]) for i in ENC_LIST])
-       idx_list = np.argmax(onehot, axis=1).tolist()
-       result_str = []
-       for i in idx_list:
-               result_str.append(enc_dict[i])
-       return np.asarray(result_str)
-
-# Convert a class to its corresponding one hot vector
-def str2onehot(Y):
-   enc_dict = dict(ENC_LIST)
-   new_Y = []
-   for y in Y:
-       vec = np.zeros((1,len(ENC_LIST)),dtype='float64')
-       vec[ 0, enc_dict[y] ] = 1.
-       new_Y.append(vec)
-   del Y
-   new_Y = np.vstack(new_Y)
-   return new_Y
+# Element-wise division which yields 0 wherever the denominator is 0, as sklearn does
+def safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype='float64')
+    denominator = np.asarray(denominator, dtype='float64')
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+# Derive per class precision, recall, F1 and support from a confusion matrix (rows are true classes)
+def per_class_scores(cf_matrix):
+    true_positives = np.diag(cf_matrix)
+    predicted = cf_matrix.sum(axis=0)
+    support = cf_matrix.sum(axis=1)
+    precision = safe_divide(true_positives, predicted)
+    recall = safe_divide(true_positives, support)
+    f1 = safe_divide(2 * true_positives, predicted + support)
+    return precision, recall, f1, support
 
 # Computes precision, recall and F1 scores for every class
-def precision_recall_f1(Y_pred, Y_test, classlist):
-    precision = precision_score(Y_test, Y_pred, average=None, labels=classlist)
-    recall = recall_score(Y_test, Y_pred, average=None, labels=classlist)
-    f1 = f1_score(Y_test, Y_pred, average=None, labels=classlist)
+def precision_recall_f1(cf_matrix, classlist):
+    precision, recall, f1, _ = per_class_scores(cf_matrix)
     metrics = {}
     for i in range(0, len(classlist)):
         metrics[classlist[i]] = { 'precision': precision[i], 'recall': recall[i], 'f1': f1[i] }
@@ -90,28 +111,29 @@ def precision_recall_f1(Y_pred, Y_test, classlist):
 # micro: Calculate metrics globally by counting the total true positives, false negatives and false positives.
 # macro: Calculate metrics for each label, and find their unweighted mean.
 # weighted: Calculate metrics for each label, and find their average, weighted by label imbalance.
-def micro_macro_weighted(Y_pred, Y_true):
+def micro_macro_weighted(cf_matrix):
+    precision, recall, f1, support = per_class_scores(cf_matrix)
+    # every sample lands in exactly one cell, so micro precision, recall and f1 all equal accuracy
+    micro = float(safe_divide(np.trace(cf_matrix), cf_matrix.sum()))
+    # like sklearn, macro averages only over classes seen in either the true or predicted labels
+    present = (support + cf_matrix.sum(axis=0)) > 0
     results = {}
-    results['micro_precision'] = precision_score(Y_true, Y_pred, average='micro')
-    results['macro_precision'] = precision_score(Y_true, Y_pred, average='macro')
-    results['weighted_precision'] = precision_score(Y_true, Y_pred, average='weighted')
-    results['micro_recall'] = recall_score(Y_true, Y_pred, average='micro')
-    results['macro_recall'] = recall_score(Y_true, Y_pred, average='macro')
-    results['weighted_recall'] = recall_score(Y_true, Y_pred, average='weighted')
-    results['micro_f1'] = f1_score(Y_true, Y_pred, average='micro')
-    results['macro_f1'] = f1_score(Y_true, Y_pred, average='macro')
-    results['weighted_f1'] = f1_score(Y_true, Y_pred, average='weighted')
+    for name, scores in [('precision', precision), ('recall', recall), ('f1', f1)]:
+        results['micro_' + name] = micro
+        results['macro_' + name] = float(np.mean(scores[present])) if present.any() else 0.
+        results['weighted_' + name] = float(safe_divide(np.dot(scores, support), support.sum()))
     return results
 
-# Calculate and display various accuracy, precision, recall and f1 scores
+# Calculate and display various accuracy, precision, recall and f1 scores, labels are given as class ids
 def calculatePerformanceMetrics(Y_pred, Y_true, dataset_type):
     assert len(Y_pred) == len(Y_true)
 
-    num_incorrect = len(Y_true) - accuracy_score(Y_true, Y_pred, normalize=False)
-    accuracy = accuracy_score(Y_true, Y_pred)
-    metrics = precision_recall_f1(Y_pred, Y_true, CLASSLIST)
-    # micro_macro_weighted_scores = micro_macro_weighted(Y_pred, Y_true)
-    cf_matrix = confusion_matrix(Y_true, Y_pred, labels=CLASSLIST)
+    # Every metric below is derived from this single pass over the predictions
+    cf_matrix = confusion_matrix(Y_true, Y_pred, labels=np.arange(len(CLASSLIST)))
+    num_incorrect = len(Y_true) - np.trace(cf_matrix)
+    accuracy = float(safe_divide(np.trace(cf_matrix), len(Y_true)))
+    metrics = precision_recall_f1(cf_matrix, CLASSLIST)
+    # micro_macro_weighted_scores = micro_macro_weighted(cf_matrix)
 
     logger.info("Results for " + dataset_type + " set...")
     logger.info("Number of cases that were incorrect: " + str(num_incorrect))
@@ -137,26 +159,17 @@ def calculatePerformanceMetrics(Y_pred, Y_true, dataset_type):
     logger.info("Confusion Matrix below " + str(CLASSLIST) + " : ")
     logger.info(str(cf_matrix))
 
-# Obtain a list of class probability values for every prediction
+# Obtain a table of class probability values for every prediction, one column per class
 def recordClassProbabilites(pred):
-    class_probabilities = []
-    for i in range(0, len(pred)):
-        prob_per_sentence = {}
-        for j in range(0, len(pred[i])):
-            prob_per_sentence[ENC_DICT[j]] = pred[i][j]
-        class_probabilities.append(prob_per_sentence)
-    return class_probabilities
-
-# Record model confidence on every prediction
-def calculatePredictionConfidence(pred):
-    CONFIDENCE_THRESHOLD = 0.65
-    confidence_list = []
-    for probs in pred:
-        if max(probs) > CONFIDENCE_THRESHOLD:
-            confidence_list.append("YES")
-        else:
-            confidence_list.append("NO")
-    return confidence_list
+    columns = [ ENC_DICT[i] for i in range(pred.shape[1]) ]
+    return pd.DataFrame(pred, columns=columns)
+
+# Summarise every prediction in one pass: best class id and whether the model is confident in it
+def summarisePredictions(pred):
+    idx = np.argmax(pred, axis=1)
+    max_prob = pred[np.arange(len(pred)), idx]
+    confidence_list = np.where(max_prob > CONFIDENCE_THRESHOLD, "YES", "NO").tolist()
+    return idx, confidence_list
 
 # # Prepare a detailed log of all incorrect cases
 # def logIncorrectCases(..., appendFileNameString):
@@ -169,47 +182,97 @@ def writeDatasetToExcel(X, y, filepath):
             'Label': y,
             'Text': X
         })
-    writer = pd.ExcelWriter(filepath)
-    df.to_excel(writer, "Sheet1", index=False)
-    writer.save()
+    with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name="Sheet1", index=False)
 
 # Obtain a list of all classes for each prediction for which probability is greater than a threshold
 def prob2str_multibucket(probs,sens):
-    enc_dict = dict([(i[1],i[0]) for i in ENC_LIST])
-    cats = []
-    final_sens = []
-    for (prob,sen) in zip(probs,sens):
-        classes = ""
-        for idx,pro in enumerate(prob):
-            if pro >= PROB_THRESHOLD:
-                classes += enc_dict[idx] + ", "
-        cats.append(classes[:-2])
-        final_sens.append(sen)
-    return np.asarray(cats), final_sens
+    # pair probabilities with sentences like zip does, truncating both to the shorter of the two
+    sens = list(sens)
+    probs = np.asarray(probs)[:len(sens)]
+    sens = sens[:len(probs)]
+    if len(probs) == 0:
+        return np.asarray([]), sens
+    assert probs.ndim == 2 and probs.shape[1] == len(LABELS), \
+        "Expected probabilities of shape (n, " + str(len(LABELS)) + "), got " + str(probs.shape)
+    mask = probs >= PROB_THRESHOLD
+    codes = mask.astype(np.int64).dot(1 << np.arange(mask.shape[1]))
+    return MULTIBUCKET_LABELS[codes], sens
+
+# Dense layer followed by LeakyReLU and Dropout, replacing the three stock layers of each block
+# these are still separate TF ops, any kernel fusion comes from XLA (USE_XLA), which fuses the stock layers equally well
+# saved models containing this layer must be loaded with custom_objects={'DenseLeakyDrop': DenseLeakyDrop}
+class DenseLeakyDrop(Layer):
+    def __init__(self, units, alpha=0.3, rate=0.2, **kwargs):
+        super(DenseLeakyDrop, self).__init__(**kwargs)
+        self.units = units
+        self.alpha = alpha
+        self.rate = rate
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel', shape=(int(input_shape[-1]), self.units), initializer='glorot_uniform')
+        self.bias = self.add_weight(name='bias', shape=(self.units,), initializer='zeros')
+        super(DenseLeakyDrop, self).build(input_shape)
+
+    def call(self, inputs, training=None):
+        x = tf.nn.leaky_relu(tf.nn.bias_add(tf.matmul(inputs, self.kernel), self.bias), alpha=self.alpha)
+        return tf.nn.dropout(x, rate=self.rate) if training else x
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.units,)
+
+    def get_config(self):
+        config = { 'units': self.units, 'alpha': self.alpha, 'rate': self.rate }
+        base_config = super(DenseLeakyDrop, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+# Track the weights with the best monitored value in memory and write the best model to disk once training ends
+# mode is 'min', 'max' or 'auto', where 'auto' maximises accuracy metrics and minimises everything else
+class BestWeightsInMemory(Callback):
+    def __init__(self, filepath, monitor='val_loss', mode='auto'):
+        super(BestWeightsInMemory, self).__init__()
+        assert mode in ('auto', 'min', 'max'), "Unknown mode: " + str(mode)
+        self.filepath = filepath
+        self.monitor = monitor
+        if mode == 'auto':
+            mode = 'max' if 'acc' in monitor else 'min'
+        self.improved = np.greater if mode == 'max' else np.less
+
+    def on_train_begin(self, logs=None):
+        self.best = -np.inf if self.improved is np.greater else np.inf
+        self.best_weights = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is not None and self.improved(current, self.best):
+            self.best = current
+            self.best_weights = self.model.get_weights()
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is None:
+            return
+        self.model.set_weights(self.best_weights)
+        self.model.save(self.filepath)
+        logger.info("Saved model with best " + self.monitor + " of " + str(self.best) + " to " + self.filepath)
 
 # Initialise neural network model using Keras
 def initialiseModel(X_train):
     main_input = Input(shape=(X_train[0].size,))
-    x = Dense(512)(main_input)
-    x = LeakyReLU()(x)
-    x = Dropout(0.2)(x)
-    x = Dense(512)(x)
-    x = LeakyReLU()(x)
-    x = Dropout(0.2)(x)
-    x = Dense(256)(x)
-    x = LeakyReLU()(x)
-    x = Dropout(0.2)(x)
-    x = Dense(128)(x)
-    x = LeakyReLU()(x)
-    x = Dropout(0.2)(x)
-    x = Dense(64)(x)
-    x = LeakyReLU()(x)
-    x = Dropout(0.2)(x)
-    output = Dense(6, activation = 'softmax')(x)
+    x = main_input
+    for units in (512, 512, 256, 128, 64):
+        x = DenseLeakyDrop(units)(x)
+    x = Dense(6)(x)
+    # keep softmax and loss in float32 for numerical stability under mixed precision
+    output = Activation('softmax', dtype='float32')(x)
     model = Model(inputs = main_input, outputs = output)
     # from keras import optimizers
     # sgd = optimizers.SGD(lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
-    model.compile(optimizer = 'adam', loss = 'categorical_crossentropy', metrics = ['accuracy'])
+    optimizer = Adam(learning_rate=LEARNING_RATE)
+    if USE_MIXED_PRECISION:
+        optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+    # run a whole epoch of training steps per compiled call to cut per-step framework overhead
+    steps_per_epoch = int(np.ceil(len(X_train) / float(BATCH_SIZE)))
+    model.compile(optimizer = optimizer, loss = 'categorical_crossentropy', metrics = ['accuracy'], steps_per_execution = steps_per_epoch, jit_compile = USE_XLA)
     return model
 
 # Train the model, monitor on validation loss and save the best model out of given epochs
@@ -217,10 +280,17 @@ def fitModel(X_train, Y_train, X_val, Y_val):
     # X_train, X_val, Y_train, Y_val = train_test_split(X, Y, shuffle=True)
     model = initialiseModel(X_train)
     filepath = os.path.join("nn_models", "nn_model.hdf5")
-    checkpoint = ModelCheckpoint(filepath, monitor='val_loss', verbose=1, save_best_only=True, mode='auto')
+    checkpoint = BestWeightsInMemory(filepath, monitor='val_loss', mode='auto')
     callbacks_list = [checkpoint]
-    sample_weight = compute_sample_weight('balanced', Y_train)
-    model.fit(X_train, str2onehot(Y_train), epochs=100, validation_data=(X_val, str2onehot(Y_val)), batch_size=50, callbacks=callbacks_list, sample_weight=sample_weight)
+    # 'balanced' weights, one per class: n_samples / (n_classes * count)
+    counts = np.bincount(Y_train, minlength=len(ENC_LIST))
+    balanced = counts.sum() / (np.count_nonzero(counts) * np.maximum(counts, 1))
+    class_weight = { i: float(balanced[i]) for i in range(len(ENC_LIST)) }
+    Y_train_oh = np.eye(len(ENC_LIST), dtype=np.float32)[Y_train]
+    Y_val_oh = np.eye(len(ENC_LIST), dtype=np.float32)[Y_val]
+    train_ds = tf.data.Dataset.from_tensor_slices((X_train, Y_train_oh)).shuffle(len(X_train)).batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    val_ds = tf.data.Dataset.from_tensor_slices((X_val, Y_val_oh)).batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    model.fit(train_ds, epochs=EPOCHS, validation_data=val_ds, callbacks=callbacks_list, class_weight=class_weight)
     return model
 
 def loadDataset(X_PATH, Y_PATH):
@@ -231,20 +301,15 @@ def loadDataset(X_PATH, Y_PATH):
             X.append(list(map(float, input[:-1].split(" "))))
     with open(Y_PATH) as y_file:
         for input in y_file:
-            Y.append(ENC_DICT[int(input) - 1])
-    classes_removed = [
-        'STAND_TO_SIT',
-        'SIT_TO_STAND',
-        'SIT_TO_LIE',
-        'LIE_TO_SIT',
-        'STAND_TO_LIE',
-        'LIE_TO_STAND'
-    ]
-
-    del_idx = [ idx for idx, val in enumerate(Y) if val in classes_removed ]
-    X = np.delete(X, del_idx, axis=0)
-    Y = np.delete(Y, del_idx)
-    return X, Y
+            Y.append(int(input) - 1)
+    # Keep labels as class ids from here on, names are only needed when logging
+    Y = np.array(Y, dtype=np.int8)
+
+    # Drop the transition classes (STAND_TO_SIT etc.), whose ids come after every class in ENC_LIST
+    keep = Y < len(ENC_LIST)
+    # Keras trains in float32 anyway, cast once here so every batch moves half the bytes
+    X = np.ascontiguousarray(np.array(X, dtype=np.float32)[keep])
+    return X, Y[keep]
 
 X_TRAIN_TXT_PATH = os.path.join(CG3002_FILEPATH, "Raspberry_Pi\\dummy_dataset\\Train\\X_train.txt")
 Y_TRAIN_TXT_PATH = os.path.join(CG3002_FILEPATH, "Raspberry_Pi\\dummy_dataset\\Train\\y_train.txt")
@@ -253,7 +318,7 @@ Y_TEST_TXT_PATH = os.path.join(CG3002_FILEPATH, "Raspberry_Pi\\dummy_dataset\\Te
 
 if __name__ == "__main__":
 
-    X, Y = loadDataset(X_TRAIN_TXT_PATH, Y_TRAIN_TXT_PATH)
+    X_train, Y_train = loadDataset(X_TRAIN_TXT_PATH, Y_TRAIN_TXT_PATH)
     X_test, Y_test = loadDataset(X_TEST_TXT_PATH, Y_TEST_TXT_PATH)
 
     logger.info("Vectorizing...")
@@ -266,37 +331,33 @@ if __name__ == "__main__":
 
     X_val, X_test, Y_val, Y_test = train_test_split(X_test, Y_test, test_size=0.5, random_state=42, shuffle=True, stratify=Y_test)
 
-    logger.info(str(Counter(Y)))
-    logger.info(str(Counter(Y_val)))
-    logger.info(str(Counter(Y_test)))
+    logger.info(str(Counter(LABELS[Y_train])))
+    logger.info(str(Counter(LABELS[Y_val])))
+    logger.info(str(Counter(LABELS[Y_test])))
 
-    model = fitModel(X, Y, X_val, Y_val)
+    model = fitModel(X_train, Y_train, X_val, Y_val)
 
     logger.info("Predicting...")
-    train_pred = model.predict(X_train)
-    val_pred = model.predict(X_val)
-    test_pred = model.predict(X_test)
+    # Predict on all three sets in one call and split the output back up
+    sizes = [len(X_train), len(X_val), len(X_test)]
+    all_pred = model.predict(np.concatenate([X_train, X_val, X_test]), batch_size=4096, verbose=0)
+    train_pred, val_pred, test_pred = np.split(all_pred, np.cumsum(sizes)[:-1])
     logger.info("Predictions done! Compiling results...")
 
-    # Convert model output of class probabilities to corresponding best predictions
-    Y_train_pred = onehot2str(train_pred)
-    Y_val_pred = onehot2str(val_pred)
-    Y_test_pred = onehot2str(test_pred)
+    # Convert model output of class probabilities to best predicted class ids and record model confidence on every prediction
+    Y_train_pred, train_confidence_list = summarisePredictions(train_pred)
+    Y_val_pred, val_confidence_list = summarisePredictions(val_pred)
+    Y_test_pred, test_confidence_list = summarisePredictions(test_pred)
 
     # Calculate accuracy, precision, recall and f1 scores
     calculatePerformanceMetrics(Y_train_pred, Y_train, "training")
     calculatePerformanceMetrics(Y_val_pred, Y_val, "validation")
     calculatePerformanceMetrics(Y_test_pred, Y_test, "testing")
 
-    # Record model confidence on every prediction
-    train_confidence_list = calculatePredictionConfidence(train_pred)
-    val_confidence_list = calculatePredictionConfidence(val_pred)
-    test_confidence_list = calculatePredictionConfidence(test_pred)
-
     # Record class probabilities for every prediction
-    train_dict_list = recordClassProbabilites(train_pred)
-    val_dict_list = recordClassProbabilites(val_pred)
-    test_dict_list = recordClassProbabilites(test_pred)
+    train_class_probabilities = recordClassProbabilites(train_pred)
+    val_class_probabilities = recordClassProbabilites(val_pred)
+    test_class_probabilities = recordClassProbabilites(test_pred)
 
     # # Prepare a detailed log of all incorrect cases on every prediction as text file
     # logIncorrectCases(..., 'training-crossval')